@@ -108,7 +108,8 @@ def main():
     else:
         lr = args.lr
     h = 1/n_grid
-    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr,
+                                 **fused_optim_kwargs(torch.optim.Adam, cuda))
     scheduler = OneCycleLR(optimizer, max_lr=lr, div_factor=1e4, final_div_factor=1e4,
                            steps_per_epoch=len(train_loader), epochs=epochs)
 
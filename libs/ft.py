@@ -307,13 +307,14 @@ class BurgersDataset(Dataset):
         else:
             edges = edge[..., None]
 
-        distance = get_distance_matrix(grid, graph=False)
         mass = get_mass_1d(grid, normalize=False).toarray().astype(np.float32)
 
         if self.return_mass_features and self.return_distance_features:
+            distance = get_distance_matrix(grid, graph=False)
             mass = mass[..., None]
             edges = np.concatenate([edges, distance, mass], axis=2)
         elif self.return_distance_features:
+            distance = get_distance_matrix(grid, graph=False)
             edges = np.concatenate([edges, distance], axis=2)
         return edges, mass
 
@@ -343,10 +344,10 @@ class BurgersDataset(Dataset):
             else:
                 edges = edge[..., np.newaxis]
 
-            distance = get_distance_matrix(grid, graph=False)
             mass = get_mass_1d(
                 grid, normalize=False).toarray().astype(np.float32)
             if self.return_distance_features:
+                distance = get_distance_matrix(grid, graph=False)
                 edges = np.concatenate([edges, distance], axis=2)
             edge_features = torch.from_numpy(edges)
             mass = torch.from_numpy(mass)
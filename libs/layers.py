@@ -40,6 +40,30 @@ class Identity(nn.Module):
         return self.id(x)
 
 
+class ConcatLinear(nn.Module):
+    '''
+    Linear layer on [x, pos] without materializing the concatenation:
+        out = x W_x^T + pos W_p^T + b
+    the weight is a single (out, in+pos) nn.Linear named id
+    so the state dict matches Identity(in_features=in+pos, out_features=out)
+    Input: x (..., in_features), pos (..., pos_features)
+    Output: (..., out_features)
+    '''
+
+    def __init__(self, in_features, pos_features, out_features):
+        super(ConcatLinear, self).__init__()
+        self.in_features = in_features
+        self.id = nn.Linear(in_features + pos_features, out_features)
+
+    def forward(self, x, pos):
+        weight = self.id.weight
+        out = F.linear(x, weight[:, :self.in_features], self.id.bias)
+        out_2d = out.view(-1, out.size(-1))
+        out_2d.addmm_(pos.reshape(-1, pos.size(-1)),
+                      weight[:, self.in_features:].t())
+        return out
+
+
 class Shortcut2d(nn.Module):
     '''
     (-1, in, S, S) -> (-1, out, S, S)
@@ -62,11 +86,15 @@ class PositionalEncoding(nn.Module):
     '''
     https://pytorch.org/tutorials/beginner/transformer_tutorial.html
     This is not necessary if spacial coords are given
+    batch_first: input is (batch, seq_len, d_model) instead of
+    (seq_len, batch, d_model), the pe buffer is then read through a
+    transposed view so the stored buffer (and the state dict) is unchanged
     '''
 
-    def __init__(self, d_model, dropout=0.1, max_len=2**12):
+    def __init__(self, d_model, dropout=0.1, max_len=2**12, batch_first=False):
         super(PositionalEncoding, self).__init__()
         self.dropout = nn.Dropout(dropout)
+        self.batch_first = batch_first
 
         pe = torch.zeros(max_len, d_model)
         position = torch.arange(0, max_len, dtype=torch.float).unsqueeze(1)
@@ -77,8 +105,16 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0).transpose(0, 1)
         self.register_buffer('pe', pe)
 
+    def __setstate__(self, state):
+        if 'batch_first' not in state:
+            state['batch_first'] = False
+        super(PositionalEncoding, self).__setstate__(state)
+
     def forward(self, x):
-        x = x + self.pe[:x.size(0), :]
+        if self.batch_first:
+            x = x + self.pe[:x.size(1), :].transpose(0, 1)
+        else:
+            x = x + self.pe[:x.size(0), :]
         return self.dropout(x)
 
 
@@ -176,11 +212,11 @@ class GraphConvolution(nn.Module):
 
     def forward(self, x, edge):
         if x.size(-1) != self.in_features:
-            x = x.transpose(-2, -1).contiguous()
+            x = x.transpose(-2, -1)
         assert x.size(1) == edge.size(-1)
         support = torch.matmul(x, self.weight)
 
-        support = support.transpose(-2, -1).contiguous()
+        support = support.transpose(-2, -1)
         output = torch.matmul(edge, support.unsqueeze(-1))
 
         output = output.squeeze()
@@ -695,7 +731,7 @@ def attention(query, key, value,
             p_attn = scores / seq_len
 
     if dropout is not None:
-        p_attn = F.dropout(p_attn)
+        p_attn = F.dropout(p_attn, p=dropout.p, training=dropout.training)
 
     out = torch.matmul(p_attn, value)
 
@@ -725,7 +761,7 @@ def linear_attention(query, key, value,
     p_attn = scores / seq_len
 
     if dropout is not None:
-        p_attn = F.dropout(p_attn)
+        p_attn = F.dropout(p_attn, p=dropout.p, training=dropout.training)
 
     out = torch.matmul(query, p_attn)
     return out, p_attn
@@ -743,6 +779,12 @@ class SimpleAttention(nn.Module):
         - softmax: classic softmax attention
 
     In this implementation, output is (N, L, E).
+    If return_weight is False, the softmax attention is dispatched to
+    F.scaled_dot_product_attention (PyTorch >= 2.0, FlashAttention on CUDA),
+    which does not materialize the attention matrix, so attn_weight is None.
+    If attn_chunk is given and return_weight is False, the (QK^T)V attention
+    is computed for attn_chunk queries at a time to bound the peak memory
+    of the (N, n_head, L, L) scores; the result is identical.
     batch_first will be added in the next version of PyTorch: https://github.com/pytorch/pytorch/pull/55285
 
     Reference: code base modified from
@@ -770,6 +812,8 @@ class SimpleAttention(nn.Module):
                  norm=False,
                  norm_type='layer',
                  eps=1e-5,
+                 return_weight=True,
+                 attn_chunk=None,
                  debug=False):
         super(SimpleAttention, self).__init__()
         assert d_model % n_head == 0
@@ -778,7 +822,7 @@ class SimpleAttention(nn.Module):
         self.n_head = n_head
         self.pos_dim = pos_dim
         self.linears = nn.ModuleList(
-            [copy.deepcopy(nn.Linear(d_model, d_model)) for _ in range(3)])
+            [nn.Linear(d_model, d_model) for _ in range(3)])
         self.xavier_init = xavier_init
         self.diagonal_weight = diagonal_weight
         self.symmetric_init = symmetric_init
@@ -793,9 +837,18 @@ class SimpleAttention(nn.Module):
             self.fc = nn.Linear(d_model + n_head*pos_dim, d_model)
 
         self.attn_weight = None
+        self.return_weight = return_weight
+        self.attn_chunk = attn_chunk
         self.dropout = nn.Dropout(dropout)
         self.debug = debug
 
+    def __setstate__(self, state):
+        if 'return_weight' not in state:
+            state['return_weight'] = True
+        if 'attn_chunk' not in state:
+            state['attn_chunk'] = None
+        super(SimpleAttention, self).__setstate__(state)
+
     def forward(self, query, key, value, pos=None, mask=None, weight=None):
         if mask is not None:
             mask = mask.unsqueeze(1)
@@ -813,12 +866,8 @@ class SimpleAttention(nn.Module):
                 if self.norm_type == 'instance':
                     key, value = key.transpose(-2, -1), value.transpose(-2, -1)
 
-                key = torch.stack(
-                    [norm(x) for norm, x in
-                     zip(self.norm_K, (key[:, i, ...] for i in range(self.n_head)))], dim=1)
-                value = torch.stack(
-                    [norm(x) for norm, x in
-                     zip(self.norm_V, (value[:, i, ...] for i in range(self.n_head)))], dim=1)
+                key = self._norm_heads(key, self.norm_K)
+                value = self._norm_heads(value, self.norm_V)
 
                 if self.norm_type == 'instance':
                     key, value = key.transpose(-2, -1), value.transpose(-2, -1)
@@ -826,12 +875,8 @@ class SimpleAttention(nn.Module):
                 if self.norm_type == 'instance':
                     key, query = key.transpose(-2, -1), query.transpose(-2, -1)
 
-                key = torch.stack(
-                    [norm(x) for norm, x in
-                     zip(self.norm_K, (key[:, i, ...] for i in range(self.n_head)))], dim=1)
-                query = torch.stack(
-                    [norm(x) for norm, x in
-                     zip(self.norm_Q, (query[:, i, ...] for i in range(self.n_head)))], dim=1)
+                key = self._norm_heads(key, self.norm_K)
+                query = self._norm_heads(query, self.norm_Q)
 
                 if self.norm_type == 'instance':
                     key, query = key.transpose(-2, -1), value.transpose(-2, -1)
@@ -848,6 +893,24 @@ class SimpleAttention(nn.Module):
                                                    mask=mask,
                                                    attention_type=self.attention_type,
                                                    dropout=self.dropout)
+        elif self.attention_type == 'softmax' and not self.return_weight \
+                and mask is None and hasattr(F, 'scaled_dot_product_attention'):
+            dropout_p = self.dropout.p if self.training else 0.0
+            x = F.scaled_dot_product_attention(query, key, value,
+                                               dropout_p=dropout_p)
+            self.attn_weight = None
+        elif self.attn_chunk and not self.return_weight \
+                and self.attention_type in ['fourier', 'integral', 'local', 'softmax'] \
+                and query.size(-2) > self.attn_chunk:
+            queries = query.split(self.attn_chunk, dim=-2)
+            masks = mask.split(self.attn_chunk, dim=-2) if mask is not None \
+                else [None]*len(queries)
+            x = torch.cat([attention(q, key, value,
+                                     mask=m,
+                                     attention_type=self.attention_type,
+                                     dropout=self.dropout)[0]
+                           for q, m in zip(queries, masks)], dim=-2)
+            self.attn_weight = None
         else:
             x, self.attn_weight = attention(query, key, value,
                                             mask=mask,
@@ -877,6 +940,26 @@ class SimpleAttention(nn.Module):
             else:
                 constant_(param, 0)
 
+    def _norm_heads(self, x, norms):
+        '''
+        x: (bsz, n_head, seq_len, d_k), the i-th norm is applied to the i-th head
+        the layer norms of all heads share normalized_shape and eps,
+        so they are done in a single F.layer_norm followed by
+        a fused per-head affine instead of n_head norms + torch.stack
+        '''
+        if self.norm_type == 'layer':
+            norm = norms[0]
+            x = F.layer_norm(x, norm.normalized_shape, eps=norm.eps)
+            if norm.weight is not None:
+                weight = torch.stack([n.weight for n in norms]).unsqueeze(1)
+                bias = torch.stack([n.bias for n in norms]).unsqueeze(1)
+                x = torch.addcmul(bias, x, weight)
+            return x
+        else:
+            return torch.stack(
+                [norm(x) for norm, x in
+                 zip(norms, (x[:, i, ...] for i in range(self.n_head)))], dim=1)
+
     def _get_norm(self, eps):
         if self.attention_type in ['linear', 'galerkin', 'global']:
             if self.norm_type == 'instance':
@@ -908,12 +991,12 @@ class SimpleAttention(nn.Module):
     @staticmethod
     def _get_layernorm(normalized_dim, n_head, **kwargs):
         return nn.ModuleList(
-            [copy.deepcopy(nn.LayerNorm(normalized_dim, **kwargs)) for _ in range(n_head)])
+            [nn.LayerNorm(normalized_dim, **kwargs) for _ in range(n_head)])
 
     @staticmethod
     def _get_instancenorm(normalized_dim, n_head, **kwargs):
         return nn.ModuleList(
-            [copy.deepcopy(nn.InstanceNorm1d(normalized_dim, **kwargs)) for _ in range(n_head)])
+            [nn.InstanceNorm1d(normalized_dim, **kwargs) for _ in range(n_head)])
 
 
 class FeedForward(nn.Module):
@@ -928,12 +1011,13 @@ class FeedForward(nn.Module):
         n_hidden = dim_feedforward
         self.lr1 = nn.Linear(in_dim, n_hidden)
 
+        # lr1's output is not needed by its backward, so it is safe to overwrite
         if activation == 'silu':
-            self.activation = nn.SiLU()
+            self.activation = nn.SiLU(inplace=True)
         elif activation == 'gelu':
             self.activation = nn.GELU()
         else:
-            self.activation = nn.ReLU()
+            self.activation = nn.ReLU(inplace=True)
 
         self.batch_norm = batch_norm
         if self.batch_norm:
@@ -1050,7 +1134,7 @@ class SpectralConv1d(nn.Module):
 
         x = x.permute(0, 2, 1)
         x_ft = fft.rfft(x, n=seq_len, norm="ortho")
-        x_ft = torch.stack([x_ft.real, x_ft.imag], dim=-1)
+        x_ft = torch.view_as_real(x_ft)
 
         out_ft = self.complex_matmul_1d(
             x_ft[:, :, :self.modes], self.fourier_weight)
@@ -1058,7 +1142,7 @@ class SpectralConv1d(nn.Module):
         pad_size = seq_len//2 + 1 - self.modes
         out_ft = F.pad(out_ft, (0, 0, 0, pad_size), "constant", 0)
 
-        out_ft = torch.complex(out_ft[..., 0], out_ft[..., 1])
+        out_ft = torch.view_as_complex(out_ft)
 
         x = fft.irfft(out_ft, n=seq_len, norm="ortho")
 
@@ -1126,7 +1210,7 @@ class SpectralConv2d(nn.Module):
             n = x.size(1)
             assert x.size(1) == x.size(2)
         elif n_dim == 3:
-            n = int(x.size(1)**(0.5))
+            n = math.isqrt(x.size(1))
         else:
             raise ValueError("Dimension not implemented")
         in_dim = self.in_dim
@@ -1139,15 +1223,14 @@ class SpectralConv2d(nn.Module):
 
         x = x.permute(0, 3, 1, 2)
         x_ft = fft.rfft2(x, s=(n, n), norm=self.norm)
-        x_ft = torch.stack([x_ft.real, x_ft.imag], dim=-1)
+        x_ft = torch.view_as_real(x_ft)
 
-        out_ft = torch.zeros(batch_size, out_dim, n, n //
-                             2+1, 2, device=x.device)
+        out_ft = x_ft.new_zeros(batch_size, out_dim, n, n//2+1, 2)
         out_ft[:, :, :modes, :modes] = self.complex_matmul_2d(
             x_ft[:, :, :modes, :modes], self.fourier_weight[0])
         out_ft[:, :, -modes:, :modes] = self.complex_matmul_2d(
             x_ft[:, :, -modes:, :modes], self.fourier_weight[1])
-        out_ft = torch.complex(out_ft[..., 0], out_ft[..., 1])
+        out_ft = torch.view_as_complex(out_ft)
 
         x = fft.irfft2(out_ft, s=(n, n), norm=self.norm)
         x = x.permute(0, 2, 3, 1)
@@ -1159,4 +1242,26 @@ class SpectralConv2d(nn.Module):
         if self.return_freq:
             return x, out_ft
         else:
-            return x
\ No newline at end of file
+            return x
+
+if __name__ == '__main__':
+    # chunked query attention (no weights returned) has to match
+    # the full (QK^T)V attention that returns the weights
+    torch.manual_seed(0)
+    bsz, seq_len, d_model, pos_dim = 2, 37, 32, 1
+    x = torch.randn(bsz, seq_len, d_model)
+    pos = torch.rand(bsz, seq_len, pos_dim)
+    mask = (torch.rand(bsz, seq_len, seq_len) > 0.2).float()
+    for attention_type in ['fourier', 'softmax']:
+        for m in [None, mask]:
+            attn = SimpleAttention(n_head=4, d_model=d_model,
+                                   attention_type=attention_type,
+                                   pos_dim=pos_dim).eval()
+            with torch.no_grad():
+                out, _ = attn(x, x, x, pos=pos, mask=m)
+                attn.return_weight, attn.attn_chunk = False, 8
+                out_chunk, _ = attn(x, x, x, pos=pos, mask=m)
+            err = (out - out_chunk).abs().max().item()
+            print(f"{attention_type}, mask: {m is not None}, "
+                  f"chunked vs full max error: {err:.2e}")
+            assert err < 1e-5
@@ -6,9 +6,12 @@ except:
     from utils_ft import *
 
 import copy
+import math
 import os
 import sys
+import warnings
 from collections import defaultdict
+from contextlib import contextmanager, nullcontext
 from typing import Optional
 
 import torch
@@ -27,7 +30,29 @@ ADDITIONAL_ATTR = ['normalizer', 'raw_laplacian', 'return_latent',
                    'upscaler_size', 'downscaler_size', 'spacial_dim', 'spacial_fc',
                    'regressor_activation', 'attn_activation', 
                    'downscaler_activation', 'upscaler_activation',
-                   'encoder_dropout', 'decoder_dropout', 'ffn_dropout']
+                   'encoder_dropout', 'decoder_dropout', 'ffn_dropout',
+                   'attn_chunk', 'compile_encoder', 'mixed_precision',
+                   'compile_model']
+
+
+@contextmanager
+def _mixed_precision(device_type):
+    '''
+    bfloat16 autocast with TF32 matmuls/convolutions inside the block,
+    the global TF32 switches are restored on exit
+    '''
+    matmul_tf32 = torch.backends.cuda.matmul.allow_tf32
+    cudnn_tf32 = torch.backends.cudnn.allow_tf32
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    autocast = torch.autocast(device_type=device_type, dtype=torch.bfloat16) \
+        if hasattr(torch, 'autocast') else nullcontext()
+    try:
+        with autocast:
+            yield
+    finally:
+        torch.backends.cuda.matmul.allow_tf32 = matmul_tf32
+        torch.backends.cudnn.allow_tf32 = cudnn_tf32
 
 
 class FourierTransformerEncoderLayer(nn.Module):
@@ -51,6 +76,7 @@ class FourierTransformerEncoderLayer(nn.Module):
                  activation_type='relu',
                  dropout=0.1,
                  ffn_dropout=None,
+                 attn_chunk=None,
                  debug=False,
                  ):
         super(FourierTransformerEncoderLayer, self).__init__()
@@ -75,6 +101,8 @@ class FourierTransformerEncoderLayer(nn.Module):
                                     norm=attn_norm,
                                     norm_type=norm_type,
                                     eps=norm_eps,
+                                    return_weight=attn_weight,
+                                    attn_chunk=attn_chunk,
                                     dropout=dropout)
         self.d_model = d_model
         self.n_head = n_head
@@ -90,17 +118,24 @@ class FourierTransformerEncoderLayer(nn.Module):
                               activation=activation_type,
                               dropout=ffn_dropout,
                               )
-        self.dropout1 = nn.Dropout(dropout)
-        self.dropout2 = nn.Dropout(dropout)
+        self.dropout_p = dropout  # residual dropouts, F.dropout in forward
         self.residual_type = residual_type  # plus or minus
         self.add_pos_emb = pos_emb
         if self.add_pos_emb:
-            self.pos_emb = PositionalEncoding(d_model)
+            self.pos_emb = PositionalEncoding(d_model, batch_first=True)
 
         self.debug = debug
         self.attn_weight = attn_weight
         self.__name__ = attention_type.capitalize() + 'TransformerEncoderLayer'
 
+    def __setstate__(self, state):
+        if 'dropout_p' not in state:
+            state['dropout_p'] = state['_modules']['dropout1'].p
+        super(FourierTransformerEncoderLayer, self).__setstate__(state)
+        if self.add_pos_emb:
+            # layers pickled before pos_emb went batch-first
+            self.pos_emb.batch_first = True
+
     def forward(self, x, pos=None, weight=None):
         '''
         - x: node feature, (batch_size, seq_len, n_feats)
@@ -111,9 +146,7 @@ class FourierTransformerEncoderLayer(nn.Module):
             information if coords are in features
         '''
         if self.add_pos_emb:
-            x = x.permute((1, 0, 2))
             x = self.pos_emb(x)
-            x = x.permute((1, 0, 2))
 
         if pos is not None and self.pos_dim > 0:
             att_output, attn_weight = self.attn(
@@ -121,15 +154,16 @@ class FourierTransformerEncoderLayer(nn.Module):
         else:
             att_output, attn_weight = self.attn(x, x, x, weight=weight)
 
+        att_output = F.dropout(att_output, self.dropout_p, self.training)
         if self.residual_type in ['add', 'plus'] or self.residual_type is None:
-            x = x + self.dropout1(att_output)
+            x = x + att_output
         else:
-            x = x - self.dropout1(att_output)
+            x = x - att_output
         if self.add_layer_norm:
             x = self.layer_norm1(x)
 
         x1 = self.ff(x)
-        x = x + self.dropout2(x1)
+        x = x + F.dropout(x1, self.dropout_p, self.training)
 
         if self.add_layer_norm:
             x = self.layer_norm2(x)
@@ -149,6 +183,11 @@ class _TransformerEncoderLayer(nn.Module):
         - batch first
         batch_first has been added in PyTorch 1.9.0
         https://github.com/pytorch/pytorch/pull/55285
+        so the attention is done in (batch_size, seq_len, d_model) directly
+        without permuting the input back and forth in every layer
+        - pos_dim > 0: the coords are concatenated only to the keys/values,
+        the attention takes kdim = vdim = d_model + pos_dim directly
+        so the residual stream stays d_model, pos is then required
     """
 
     def __init__(self, d_model, nhead,
@@ -156,17 +195,21 @@ class _TransformerEncoderLayer(nn.Module):
                  dropout=0.1,
                  layer_norm=True,
                  attn_weight=False,
+                 pos_dim=0,
                  ):
         super(_TransformerEncoderLayer, self).__init__()
-        self.self_attn = MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.pos_dim = default(pos_dim, 0)
+        self.self_attn = MultiheadAttention(d_model, nhead, dropout=dropout,
+                                            kdim=d_model+self.pos_dim,
+                                            vdim=d_model+self.pos_dim,
+                                            batch_first=True)
         self.linear1 = nn.Linear(d_model, dim_feedforward)
         self.dropout = nn.Dropout(dropout)
         self.linear2 = nn.Linear(dim_feedforward, d_model)
 
         self.norm1 = nn.LayerNorm(d_model)
         self.norm2 = nn.LayerNorm(d_model)
-        self.dropout1 = nn.Dropout(dropout)
-        self.dropout2 = nn.Dropout(dropout)
+        self.dropout_p = dropout  # residual dropouts, F.dropout in forward
         self.add_layer_norm = layer_norm
         self.attn_weight = attn_weight
         self.activation = nn.ReLU()
@@ -174,6 +217,12 @@ class _TransformerEncoderLayer(nn.Module):
     def __setstate__(self, state):
         if 'activation' not in state:
             state['activation'] = F.relu
+        if 'pos_dim' not in state:
+            # layers pickled before batch_first held a (seq_len, batch) MHA
+            state['pos_dim'] = 0
+            state['_modules']['self_attn'].batch_first = True
+        if 'dropout_p' not in state:
+            state['dropout_p'] = state['_modules']['dropout1'].p
         super(_TransformerEncoderLayer, self).__setstate__(state)
 
     def forward(self, src: Tensor,
@@ -193,28 +242,29 @@ class _TransformerEncoderLayer(nn.Module):
 
         Remark: 
             PyTorch official implementation: (seq_len, n_batch, d_model) as input
-            here we permute the first two dims as input
-            so in the first line the dim needs to be permuted then permuted back
+            here the attention is built with batch_first=True
+            so no permutation is needed
         """
-        if pos is not None:
-            src = torch.cat([pos, src], dim=-1)
-
-        src = src.permute(1, 0, 2)
-
-        if (src_mask is None) or (src_key_padding_mask is None):
-            src2, attn_weight = self.self_attn(src, src, src)
+        if self.pos_dim > 0:
+            if pos is None:
+                raise RuntimeError(
+                    f"pos is required: the keys/values expect d_model+{self.pos_dim} features.")
+            src_pos = torch.cat([pos, src], dim=-1)
         else:
-            src2, attn_weight = self.self_attn(src, src, src, attn_mask=src_mask,
-                                               key_padding_mask=src_key_padding_mask)
+            src_pos = src
+
+        # need_weights=False lets MultiheadAttention use the fused SDPA kernel
+        src2, attn_weight = self.self_attn(src, src_pos, src_pos, attn_mask=src_mask,
+                                           key_padding_mask=src_key_padding_mask,
+                                           need_weights=self.attn_weight)
 
-        src = src + self.dropout1(src2)
+        src = src + F.dropout(src2, self.dropout_p, self.training)
         if self.add_layer_norm:
             src = self.norm1(src)
         src2 = self.linear2(self.dropout(self.activation(self.linear1(src))))
-        src = src + self.dropout2(src2)
+        src = src + F.dropout(src2, self.dropout_p, self.training)
         if self.add_layer_norm:
             src = self.norm2(src)
-        src = src.permute(1, 0, 2)
         if self.attn_weight:
             return src, attn_weight
         else:
@@ -297,11 +347,11 @@ class GCN(nn.Module):
                                            out_features=out_features,
                                            debug=debug,
                                            )
-        self.gcn_layers = nn.ModuleList([copy.deepcopy(GraphConvolution(
+        self.gcn_layers = nn.ModuleList([GraphConvolution(
             in_features=out_features,  # hard coded
             out_features=out_features,
             debug=debug
-        )) for _ in range(1, num_gcn_layers)])
+        ) for _ in range(1, num_gcn_layers)])
         self.activation = activation
         self.relu = nn.ReLU()
         self.dropout = nn.Dropout(dropout)
@@ -309,8 +359,12 @@ class GCN(nn.Module):
         self.debug = debug
 
     def forward(self, x, edge):
-        x = x.permute(0, 2, 1).contiguous()
-        edge = edge.permute([0, 3, 1, 2]).contiguous()
+        '''
+        x: (-1, seq_len, node_feats), fed to the first layer as is
+        edge: (-1, seq_len, seq_len, edge_feats), the permuted view is already
+        channels_last for the edge convs, no copy is needed
+        '''
+        edge = edge.permute([0, 3, 1, 2])
         assert edge.size(1) == self.edge_feats
 
         edge = self.edge_learner(edge)
@@ -341,10 +395,10 @@ class GAT(nn.Module):
         self.gat_layer0 = GraphAttention(in_features=node_feats,
                                          out_features=out_features,
                                          )
-        self.gat_layers = nn.ModuleList([copy.deepcopy(GraphAttention(
+        self.gat_layers = nn.ModuleList([GraphAttention(
             in_features=out_features,
             out_features=out_features,
-        )) for _ in range(1, num_gcn_layers)])
+        ) for _ in range(1, num_gcn_layers)])
         self.activation = activation
         self.relu = nn.ReLU()
         self.debug = debug
@@ -355,7 +409,7 @@ class GAT(nn.Module):
                edge only takes adj (-1, seq_len, seq_len)
                edge matrix first one in the last dim is graph Lap.
         '''
-        edge = edge[..., 0].contiguous()
+        edge = edge[..., 0]
 
         out = self.gat_layer0(x, edge)
 
@@ -385,24 +439,31 @@ class PointwiseRegressor(nn.Module):
         '''
         dropout = default(dropout, 0.1)
         self.spacial_fc = spacial_fc
-        activ = nn.SiLU() if activation == 'silu' else nn.ReLU()
+        activ = nn.SiLU(inplace=True) if activation == 'silu' else nn.ReLU(inplace=True)
         if self.spacial_fc:
             in_dim = in_dim + spacial_dim
             self.fc = nn.Linear(in_dim, n_hidden)
-        self.ff = nn.ModuleList([nn.Sequential(
+        self.dropout = nn.Dropout(dropout)
+        self.ff = nn.Sequential(*[nn.Sequential(
                                 nn.Linear(n_hidden, n_hidden),
                                 activ,
-                                )])
-        for _ in range(num_layers - 1):
-            self.ff.append(nn.Sequential(
-                nn.Linear(n_hidden, n_hidden),
-                activ,
-            ))
-        self.dropout = nn.Dropout(dropout)
+                                self.dropout,
+                                ) for _ in range(num_layers)])
         self.out = nn.Linear(n_hidden, out_dim)
         self.return_latent = return_latent
         self.debug = debug
 
+    def __setstate__(self, state):
+        '''
+        models pickled with ff as a ModuleList of (Linear, activation)
+        and the dropout applied in a Python loop
+        '''
+        modules = state['_modules']
+        if isinstance(modules['ff'], nn.ModuleList):
+            modules['ff'] = nn.Sequential(*[nn.Sequential(*layer, modules['dropout'])
+                                            for layer in modules['ff']])
+        super(PointwiseRegressor, self).__setstate__(state)
+
     def forward(self, x, grid=None):
         '''
         2D:
@@ -416,10 +477,7 @@ class PointwiseRegressor(nn.Module):
             x = torch.cat([x, grid], dim=-1)
             x = self.fc(x)
 
-        for layer in self.ff:
-            x = layer(x)
-            x = self.dropout(x)
-
+        x = self.ff(x)
         x = self.out(x)
 
         if self.return_latent:
@@ -508,23 +566,16 @@ class SpectralRegressor(nn.Module):
             Input: (-1, n, in_features)
             Output: (-1, n, n_targets)
         '''
-        x_latent = []
-        x_fts = []
-
         if self.spacial_fc:
             x = torch.cat([x, grid], dim=-1)
             x = self.fc(x)
 
-        for layer in self.spectral_conv:
-            if self.return_freq:
-                x, x_ft = layer(x)
-                x_fts.append(x_ft.contiguous())
-            else:
+        if self.return_freq or self.return_latent:
+            x, x_fts, x_latent = self._forward_spectral_conv(x)
+        else:
+            for layer in self.spectral_conv:
                 x = layer(x)
 
-            if self.return_latent:
-                x_latent.append(x.contiguous())
-
         x = self.regressor(x)
 
         if self.normalizer:
@@ -535,6 +586,23 @@ class SpectralRegressor(nn.Module):
         else:
             return x
 
+    def _forward_spectral_conv(self, x):
+        '''
+        spectral conv layers collecting the Fourier coeffs and/or latents
+        '''
+        x_latent = []
+        x_fts = []
+        for layer in self.spectral_conv:
+            if self.return_freq:
+                x, x_ft = layer(x)
+                x_fts.append(x_ft.contiguous())
+            else:
+                x = layer(x)
+
+            if self.return_latent:
+                x_latent.append(x.contiguous())
+        return x, x_fts, x_latent
+
 
 class DownScaler(nn.Module):
     def __init__(self, in_dim,
@@ -568,6 +636,9 @@ class DownScaler(nn.Module):
                                               debug=debug)
         else:
             raise NotImplementedError("downsample mode not implemented.")
+        if downsample_mode == 'conv':
+            # the permuted input below is channels_last already
+            self.downsample.to(memory_format=torch.channels_last)
         self.in_dim = in_dim
         self.out_dim = out_dim
 
@@ -576,6 +647,8 @@ class DownScaler(nn.Module):
         2D:
             Input: (-1, n, n, in_dim)
             Output: (-1, n_s, n_s, out_dim)
+        the permutes are views: (-1, n, n, in_dim) viewed as NCHW
+        is in channels_last format, so are the conv outputs
         '''
         n_grid = x.size(1)
         bsz = x.size(0)
@@ -633,6 +706,8 @@ class UpScaler(nn.Module):
                                              debug=debug)
         else:
             raise NotImplementedError("upsample mode not implemented.")
+        if upsample_mode in ['conv', 'deconv']:
+            self.upsample.to(memory_format=torch.channels_last)
         self.in_dim = in_dim
         self.out_dim = out_dim
 
@@ -641,6 +716,7 @@ class UpScaler(nn.Module):
         2D:
             Input: (-1, n_s, n_s, in_dim)
             Output: (-1, n, n, out_dim)
+        the permutes are views in channels_last format, see DownScaler
         '''
         x = x.permute(0, 3, 1, 2)
         x = self.upsample(x)
@@ -651,7 +727,8 @@ class UpScaler(nn.Module):
 class FourierTransformer(nn.Module):
     def __init__(self, **kwargs):
         super(FourierTransformer, self).__init__()
-        self.config = defaultdict(lambda: None, **kwargs)
+        self.config = {key: kwargs.get(key)
+                       for key in dict.fromkeys(list(kwargs) + ADDITIONAL_ATTR)}
         self._get_setting()
         self._initialize()
         self.__name__ = self.attention_type.capitalize() + 'Transformer'
@@ -674,28 +751,36 @@ class FourierTransformer(nn.Module):
         '''
         x_latent = []
         attn_weights = []
+        return_attn_weight, return_latent, spacial_residual, freq_targets = self._flags
 
         x = self.feat_extract(node, edge)
 
-        if self.spacial_residual or self.return_latent:
-            res = x.contiguous()
+        if spacial_residual or return_latent:
+            res = x
             x_latent.append(res)
 
-        for encoder in self.encoder_layers:
-            if self.return_attn_weight:
-                x, attn_weight = encoder(x, pos, weight)
-                attn_weights.append(attn_weight)
+        dtype = x.dtype
+        with self._autocast(x):
+            if return_attn_weight or return_latent:
+                for encoder in self._compiled_layers or self.encoder_layers:
+                    if return_attn_weight:
+                        x, attn_weight = encoder(x, pos, weight)
+                        attn_weights.append(attn_weight)
+                    else:
+                        x = encoder(x, pos, weight)
+
+                    if return_latent:
+                        x_latent.append(x.to(dtype))
             else:
-                x = encoder(x, pos, weight)
+                x = (self._compiled_encode or self._encode)(x, pos, weight)
+        # back to the dtype of the model (bf16 under autocast, no-op otherwise)
+        x = x.to(dtype)
 
-            if self.return_latent:
-                x_latent.append(x.contiguous())
-
-        if self.spacial_residual:
+        if spacial_residual:
             x = res + x
 
         x_freq = self.freq_regressor(
-            x)[:, :self.pred_len, :] if self.n_freq_targets > 0 else None
+            x)[:, :self.pred_len, :] if freq_targets else None
 
         x = self.dpo(x)
         x = self.regressor(x, grid=grid)
@@ -705,6 +790,71 @@ class FourierTransformer(nn.Module):
                     preds_latent=x_latent,
                     attn_weights=attn_weights)
 
+    def _encode(self, x, pos=None, weight=None):
+        '''
+        the encoder stack when neither attn weights nor latents are returned
+        '''
+        for encoder in self.encoder_layers:
+            x = encoder(x, pos, weight)
+        return x
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # not picklable, recapture/recompile after loading
+        state.pop('_cuda_graph', None)
+        state['_compiled_encode'] = None
+        state['_compiled_layers'] = None
+        return state
+
+    def __setstate__(self, state):
+        if 'mixed_precision' not in state:
+            state['mixed_precision'] = None
+        # older pickles stored the switches resolved at construction
+        state.pop('_flags', None)
+        super(FourierTransformer, self).__setstate__(state)
+        if '_compiled_encode' not in state:
+            self._compiled_encode = None
+        if '_compiled_layers' not in state:
+            self._compiled_layers = None
+
+    def capture_graph(self, node, edge, pos, grid=None, weight=None, num_warmup=3):
+        '''
+        Capture the inference forward into a CUDA graph for fixed input shapes,
+        the inputs are copied into static buffers and replayed by replay_graph,
+        removing the per-kernel launch overhead for small batches/short sequences
+        - inputs: same as forward, on the cuda device, with the shapes to be replayed
+        '''
+        if not (node.is_cuda and hasattr(torch.cuda, 'CUDAGraph')):
+            raise RuntimeError("CUDA graph capture needs cuda inputs and torch>=1.10.")
+        static = [t.clone() if t is not None else None
+                  for t in (node, edge, pos, grid, weight)]
+
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream), torch.no_grad():
+            for _ in range(num_warmup):
+                self(*static)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph), torch.no_grad():
+            out = self(*static)
+        self._cuda_graph = (graph, static, out)
+        return out
+
+    def replay_graph(self, node, edge, pos, grid=None, weight=None):
+        '''
+        Replay the graph captured by capture_graph on new inputs of the same shapes,
+        the returned tensors are the graph's static outputs and are overwritten by
+        the next replay, clone them if they need to be kept
+        '''
+        graph, static, out = self._cuda_graph
+        for buf, t in zip(static, (node, edge, pos, grid, weight)):
+            if buf is not None:
+                buf.copy_(t, non_blocking=True)
+        graph.replay()
+        return out
+
     def _initialize(self):
         self._get_feature()
 
@@ -718,20 +868,46 @@ class FourierTransformer(nn.Module):
         if self.decoder_type in ['pointwise', 'convolution']:
             self._initialize_layer(self.regressor)
 
-        self.config = dict(self.config)
+    @property
+    def _flags(self):
+        '''
+        the switches read in every forward, resolved once at the start of it
+        so that changing e.g. model.return_latent after building takes effect
+        '''
+        return (self.return_attn_weight, self.return_latent,
+                self.spacial_residual, self.n_freq_targets > 0)
+
+    def _autocast(self, x):
+        '''
+        bfloat16 autocast and TF32 for the encoder layers if mixed_precision,
+        the feature extractor and the (spectral) regressor stay in fp32
+        '''
+        if self.mixed_precision:
+            return _mixed_precision(x.device.type)
+        return nullcontext()
 
     @staticmethod
     def _initialize_layer(layer, gain=1e-2):
+        '''
+        xavier_uniform_ per weight (the bound depends on each fan-in/out),
+        all the biases zeroed in one foreach call if available
+        '''
+        biases = []
         for param in layer.parameters():
             if param.ndim > 1:
                 xavier_uniform_(param, gain=gain)
             else:
+                biases.append(param)
+        if hasattr(torch, '_foreach_zero_') and biases:
+            with torch.no_grad():
+                torch._foreach_zero_(biases)
+        else:
+            for param in biases:
                 constant_(param, 0)
 
     def _get_setting(self):
-        all_attr = list(self.config.keys()) + ADDITIONAL_ATTR
-        for key in all_attr:
-            setattr(self, key, self.config[key])
+        for key, val in self.config.items():
+            setattr(self, key, val)
 
         self.dim_feedforward = default(self.dim_feedforward, 2*self.n_hidden)
         self.spacial_dim = default(self.spacial_dim, self.pos_dim)
@@ -783,6 +959,7 @@ class FourierTransformer(nn.Module):
                                                            activation_type=self.attn_activation,
                                                            dropout=self.encoder_dropout,
                                                            ffn_dropout=self.ffn_dropout,
+                                                           attn_chunk=self.attn_chunk,
                                                            debug=self.debug)
         else:
             encoder_layer = _TransformerEncoderLayer(d_model=self.n_hidden,
@@ -790,11 +967,37 @@ class FourierTransformer(nn.Module):
                                                     dim_feedforward=self.dim_feedforward,
                                                     layer_norm=self.layer_norm,
                                                     attn_weight=self.return_attn_weight,
-                                                    dropout=self.encoder_dropout
+                                                    dropout=self.encoder_dropout,
+                                                    pos_dim=self.pos_dim,
                                                     )
         self.encoder_layers = nn.ModuleList(
             [copy.deepcopy(encoder_layer) for _ in range(self.num_encoder_layers)])
 
+        self._compiled_encode = None
+        self._compiled_layers = None
+        if self.compile_encoder:
+            self._compile_encoder()
+
+    def _compile_encoder(self):
+        '''
+        torch.compile the encoder so that the
+        dropout -> residual add -> layer norm chains are fused,
+        state dict keys are unchanged.
+        Without latents the whole stack is one graph (fusion across layers),
+        with latents each layer is compiled separately, the compiled layers
+        are kept outside encoder_layers so that no _orig_mod. prefix is added.
+        No-op for torch<2.0 or when attention weights are returned.
+        '''
+        if not hasattr(torch, 'compile') or self.return_attn_weight:
+            return
+        if not self.return_latent:
+            self._compiled_encode = torch.compile(self._encode, dynamic=False,
+                                                  mode='max-autotune')
+            return
+        self._compiled_layers = [torch.compile(encoder, dynamic=False,
+                                               mode='max-autotune')
+                                 for encoder in self.encoder_layers]
+
     def _get_freq_regressor(self):
         if self.bulk_regression:
             self.freq_regressor = BulkRegressor(in_dim=self.seq_len,
@@ -844,11 +1047,33 @@ class FourierTransformer(nn.Module):
 class FourierTransformer2D(nn.Module):
     def __init__(self, **kwargs):
         super(FourierTransformer2D, self).__init__()
-        self.config = defaultdict(lambda: None, **kwargs)
+        self.config = {key: kwargs.get(key)
+                       for key in dict.fromkeys(list(kwargs) + ADDITIONAL_ATTR)}
         self._get_setting()
         self._initialize()
         self.__name__ = self.attention_type.capitalize() + 'Transformer2D'
 
+    def __setstate__(self, state):
+        if 'mixed_precision' not in state:
+            state['mixed_precision'] = None
+        downscaler = state['_modules']['downscaler']
+        if isinstance(downscaler, Identity):
+            # models pickled with the Identity(Linear) on cat([node, pos])
+            concat_linear = ConcatLinear(in_features=state['node_feats'],
+                                         pos_features=state['spacial_dim'],
+                                         out_features=state['n_hidden'])
+            concat_linear.id = downscaler.id
+            state['_modules']['downscaler'] = concat_linear
+        super(FourierTransformer2D, self).__setstate__(state)
+        if '_compiled_forward' not in state:
+            self._compiled_forward = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # not picklable, recompile after loading
+        state['_compiled_forward'] = None
+        return state
+
     def forward(self, node, edge, pos, grid, weight=None, boundary_value=None):
         '''
         - node: (batch_size, n, n, node_feats)
@@ -858,40 +1083,51 @@ class FourierTransformer2D(nn.Module):
             or (batch_size, n_s*n_s) when mass matrices are not provided (lumped mass)
         - grid: (batch_size, n-2, n-2, 2) excluding boundary
         '''
+        return (self._compiled_forward or self._forward)(
+            node, edge, pos, grid, weight=weight, boundary_value=boundary_value)
+
+    def _forward(self, node, edge, pos, grid, weight=None, boundary_value=None):
+        '''
+        the forward pass, compiled as a whole by _compile_model
+        '''
         bsz = node.size(0)
-        n_s = int(pos.size(1)**(0.5))
+        n_s = math.isqrt(pos.size(1))
         x_latent = []
         attn_weights = []
 
         if not self.downscaler_size:
-            node = torch.cat(
-                [node, pos.contiguous().view(bsz, n_s, n_s, -1)], dim=-1)
-        x = self.downscaler(node)
+            x = self.downscaler(node, pos.reshape(bsz, n_s, n_s, -1))
+        else:
+            x = self.downscaler(node)
         x = x.view(bsz, -1, self.n_hidden)
 
         x = self.feat_extract(x, edge)
         x = self.dpo(x)
 
-        for encoder in self.encoder_layers:
-            if self.return_attn_weight and self.attention_type != 'official':
-                x, attn_weight = encoder(x, pos, weight)
-                attn_weights.append(attn_weight)
-            elif self.attention_type != 'official':
-                x = encoder(x, pos, weight)
-            else:
-                out_dim = self.n_head*self.pos_dim + self.n_hidden
-                x = x.view(bsz, -1, self.n_head, self.n_hidden//self.n_head).transpose(1, 2)
-                x = torch.cat([pos.repeat([1, self.n_head, 1, 1]), x], dim=-1)
-                x = x.transpose(1, 2).contiguous().view(bsz, -1, out_dim)
-                x = encoder(x)
-            if self.return_latent:
-                x_latent.append(x.contiguous())
-
-        x = x.view(bsz, n_s, n_s, self.n_hidden)
+        dtype = x.dtype
+        with self._autocast(x):
+            for encoder in self.encoder_layers:
+                if self.return_attn_weight and self.attention_type != 'official':
+                    x, attn_weight = encoder(x, pos, weight)
+                    attn_weights.append(attn_weight)
+                elif self.attention_type != 'official':
+                    x = encoder(x, pos, weight)
+                else:
+                    out_dim = self.n_head*self.pos_dim + self.n_hidden
+                    x = x.view(bsz, -1, self.n_head, self.n_hidden//self.n_head).transpose(1, 2)
+                    x = torch.cat([pos.repeat([1, self.n_head, 1, 1]), x], dim=-1)
+                    x = x.transpose(1, 2).reshape(bsz, -1, out_dim)
+                    x = encoder(x)
+                if self.return_latent:
+                    x_latent.append(x.to(dtype))
+        # back to the dtype of the model (bf16 under autocast, no-op otherwise)
+        x = x.to(dtype)
+
+        x = x.reshape(bsz, n_s, n_s, self.n_hidden)
         x = self.upscaler(x)
 
         if self.return_latent:
-            x_latent.append(x.contiguous())
+            x_latent.append(x)
 
         x = self.dpo(x)
 
@@ -905,8 +1141,10 @@ class FourierTransformer2D(nn.Module):
             x = self.normalizer.inverse_transform(x)
 
         if self.boundary_condition == 'dirichlet':
-            x = x[:, 1:-1, 1:-1].contiguous()
-            x = F.pad(x, (0, 0, 1, 1, 1, 1), "constant", 0)
+            # zero boundary: the interior is written once into a zeroed output
+            out = x.new_zeros(x.size())
+            out[:, 1:-1, 1:-1] = x[:, 1:-1, 1:-1]
+            x = out
             if boundary_value is not None:
                 assert x.size() == boundary_value.size()
                 x += boundary_value
@@ -920,7 +1158,31 @@ class FourierTransformer2D(nn.Module):
         self._get_scaler()
         self._get_encoder()
         self._get_regressor()
-        self.config = dict(self.config)
+        self._compiled_forward = None
+        if self.compile_model:
+            self._compile_model()
+
+    def _compile_model(self):
+        '''
+        torch.compile the whole forward (torch>=2.0) with static shapes,
+        cuda graphs are used by reduce-overhead for the fixed training resolution,
+        the module itself is not wrapped so the state dict keys are unchanged,
+        and the compiled call is not pickled.
+        No-op for torch<2.0.
+        '''
+        if not hasattr(torch, 'compile'):
+            return
+        self._compiled_forward = torch.compile(self._forward, dynamic=False,
+                                               mode='reduce-overhead')
+
+    def _autocast(self, x):
+        '''
+        bfloat16 autocast and TF32 for the encoder layers if mixed_precision,
+        the scalers and the (spectral) regressor stay in fp32
+        '''
+        if self.mixed_precision:
+            return _mixed_precision(x.device.type)
+        return nullcontext()
 
     def cuda(self, device=None):
         self = super().cuda(device)
@@ -947,32 +1209,32 @@ class FourierTransformer2D(nn.Module):
 
     @staticmethod
     def _initialize_layer(layer, gain=1e-2):
+        '''
+        xavier_uniform_ per weight (the bound depends on each fan-in/out),
+        all the biases zeroed in one foreach call if available
+        '''
+        biases = []
         for param in layer.parameters():
             if param.ndim > 1:
                 xavier_uniform_(param, gain=gain)
             else:
+                biases.append(param)
+        if hasattr(torch, '_foreach_zero_') and biases:
+            with torch.no_grad():
+                torch._foreach_zero_(biases)
+        else:
+            for param in biases:
                 constant_(param, 0)
 
-    @staticmethod
-    def _get_pos(pos, downsample):
-        '''
-        get the downscaled position in 2d
-        '''
-        bsz = pos.size(0)
-        n_grid = pos.size(1)
-        x, y = pos[..., 0], pos[..., 1]
-        x = x.view(bsz, n_grid, n_grid)
-        y = y.view(bsz, n_grid, n_grid)
-        x = x[:, ::downsample, ::downsample].contiguous()
-        y = y[:, ::downsample, ::downsample].contiguous()
-        return torch.stack([x, y], dim=-1)
-
     def _get_setting(self):
-        all_attr = list(self.config.keys()) + ADDITIONAL_ATTR
-        for key in all_attr:
-            setattr(self, key, self.config[key])
+        for key, val in self.config.items():
+            setattr(self, key, val)
 
+        if self.mixed_precision:
+            self.n_hidden = self._pad_dim('n_hidden', 8, self.n_head)
         self.dim_feedforward = default(self.dim_feedforward, 2*self.n_hidden)
+        if self.mixed_precision:
+            self.dim_feedforward = self._pad_dim('dim_feedforward', 8)
         self.dropout = default(self.dropout, 0.05)
         self.dpo = nn.Dropout(self.dropout)
         if self.decoder_type == 'attention':
@@ -980,6 +1242,19 @@ class FourierTransformer2D(nn.Module):
         self.attention_types = ['fourier', 'integral', 'local', 'global',
                                 'cosine', 'galerkin', 'linear', 'softmax']
 
+    def _pad_dim(self, key, multiple=8, n_head=1):
+        '''
+        round a feature dim up to a multiple of 8 (and of n_head)
+        so that the bf16/TF32 GEMMs fill the tensor core tiles
+        '''
+        dim = getattr(self, key)
+        multiple = multiple*n_head//math.gcd(multiple, n_head)
+        padded = -(-dim//multiple)*multiple
+        if padded != dim:
+            warnings.warn(f"{key} is padded from {dim} to {padded} for mixed precision.")
+            self.config[key] = padded
+        return padded
+
     def _get_feature(self):
         if self.feat_extract_type == 'gcn' and self.num_feat_layers > 0:
             self.feat_extract = GCN(node_feats=self.n_hidden,
@@ -1009,8 +1284,9 @@ class FourierTransformer2D(nn.Module):
                                          dropout=self.downscaler_dropout,
                                          activation_type=self.downscaler_activation)
         else:
-            self.downscaler = Identity(in_features=self.node_feats+self.spacial_dim,
-                                       out_features=self.n_hidden)
+            self.downscaler = ConcatLinear(in_features=self.node_feats,
+                                           pos_features=self.spacial_dim,
+                                           out_features=self.n_hidden)
         if self.upscaler_size:
             self.upscaler = UpScaler(in_dim=self.n_hidden,
                                      out_dim=self.n_hidden,
@@ -1038,6 +1314,7 @@ class FourierTransformer2D(nn.Module):
                                                            dropout=self.encoder_dropout,
                                                            ffn_dropout=self.ffn_dropout,
                                                            norm_eps=self.norm_eps,
+                                                           attn_chunk=self.attn_chunk,
                                                            debug=self.debug)
         elif self.attention_type == 'official':
             encoder_layer = TransformerEncoderLayer(d_model=self.n_hidden+self.pos_dim*self.n_head,
@@ -1129,5 +1406,44 @@ if __name__ == '__main__':
                                 (batch_size, seq_len, 1),
                                 (batch_size, seq_len, 1)], device=device)
 
+    # float64 model: the encoder output is not cast to fp32
+    config.update(feat_extract_type=None, spacial_fc=False,
+                  num_feat_layers=0, return_attn_weight=False)
+    for decoder in ['pointwise', 'ifft']:
+        config['decoder_type'] = decoder
+        ft = FourierTransformer(**config).double().to(device)
+        node = torch.randn(2, 64, 1, dtype=torch.float64, device=device)
+        pos = torch.linspace(0, 1, 64, dtype=torch.float64, device=device)
+        pos = pos[None, :, None].repeat(2, 1, 1)
+        preds = ft(node, None, pos, grid=pos)['preds']
+        assert preds.dtype == torch.float64, decoder
+
+    # switches changed after building are picked up by the next forward
+    ft.return_latent = True
+    latent = ft(node, None, pos, grid=pos)['preds_latent']
+    assert len(latent) == config['num_encoder_layers'] + 1
+
+    config2d = defaultdict(lambda: None,
+                           node_feats=1, pos_dim=2, n_targets=1, n_hidden=32,
+                           num_feat_layers=0, feat_extract_type=None,
+                           num_encoder_layers=2, n_head=2,
+                           dim_feedforward=64, attention_type='galerkin',
+                           xavier_init=1e-2, diagonal_weight=1e-2,
+                           symmetric_init=False, layer_norm=False, attn_norm=True,
+                           batch_norm=False, return_attn_weight=False,
+                           return_latent=False, decoder_type='pointwise',
+                           spacial_dim=2, spacial_fc=False, freq_dim=32,
+                           num_regressor_layers=2, fourier_modes=8,
+                           boundary_condition='dirichlet', dropout=0.0,
+                           debug=False)
+    ft = FourierTransformer2D(**config2d).double().to(device)
+    n_s = 16
+    node = torch.randn(2, n_s, n_s, 1, dtype=torch.float64, device=device)
+    grid = torch.linspace(0, 1, n_s, dtype=torch.float64, device=device)
+    grid = torch.stack(torch.meshgrid(grid, grid, indexing='xy'), dim=-1)
+    grid = grid[None].repeat(2, 1, 1, 1)
+    preds = ft(node, None, grid.view(2, -1, 2), grid)['preds']
+    assert preds.dtype == torch.float64
+
     layer = TransformerEncoderLayer(d_model=128, nhead=4)
     print(layer.__class__)
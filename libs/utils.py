@@ -283,6 +283,15 @@ def save_pickle(var, save_path):
     with open(save_path, 'wb') as f:
         pickle.dump(var, f)
 
+def atomic_torch_save(var, save_path):
+    '''
+    torch.save to a temporary file then rename, so that an interrupted
+    save never leaves a truncated checkpoint at <save_path>
+    '''
+    tmp_path = save_path + '.tmp'
+    torch.save(var, tmp_path)
+    os.replace(tmp_path, save_path)
+
 def load_pickle(load_path):
     with open(load_path, 'rb') as f:
         u = pickle.load(f)
@@ -1,8 +1,10 @@
 import argparse
+import inspect
 import math
 import os
 import sys
 from collections import OrderedDict
+from contextlib import nullcontext
 from datetime import date
 
 import numpy as np
@@ -14,7 +16,7 @@ from scipy.io import loadmat
 from scipy.sparse import csr_matrix, diags
 from scipy.sparse import hstack as sparse_hstack
 from torch import nn
-from torch.optim.lr_scheduler import OneCycleLR, _LRScheduler
+from torch.optim.lr_scheduler import OneCycleLR, ReduceLROnPlateau, _LRScheduler
 from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 
@@ -31,6 +33,11 @@ try:
 except ImportError as e:
     print('Please install Plotly for showing mesh and solutions.')
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit, prange = None, range
+
 current_path = os.path.dirname(os.path.abspath(__file__))
 SRC_ROOT = os.path.dirname(current_path)
 MODEL_PATH = default(os.environ.get('MODEL_PATH'),
@@ -42,7 +49,11 @@ FIG_PATH = default(os.environ.get('FIG_PATH'),
 EPOCH_SCHEDULERS = ['ReduceLROnPlateau', 'StepLR', 'MultiplicativeLR',
                     'MultiStepLR', 'ExponentialLR', 'LambdaLR']
 PI = math.pi
+# torch>=2.0 clips all the gradients with a single multi-tensor kernel
+CLIP_GRAD_KWARGS = {'foreach': True} if 'foreach' in inspect.signature(
+    nn.utils.clip_grad_norm_).parameters else {}
 SEED = default(os.environ.get('SEED'), 1127802)
+USE_COMPILE = default(os.environ.get('USE_COMPILE'), '0') == '1'
 
 
 def clones(module, N):
@@ -58,10 +69,50 @@ def clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for _ in range(N)])
 
 
-def csr_to_sparse(M):
+def no_sync_context(model, step, accumulation_steps=1):
+    '''
+    Input:
+        - model: nn.Module obj, possibly wrapped by DistributedDataParallel
+        - step: index of the current micro-batch, starting from 0
+        - accumulation_steps: number of micro-batches per optimizer step
+    Output:
+        - model.no_sync() for all but the last micro-batch of an
+        accumulation window so that DDP all-reduces the gradients once,
+        a null context otherwise or if the model is not DDP
+
+    Usage:
+        with no_sync_context(model, step, accum):
+            loss.backward()
+    '''
+    if hasattr(model, 'no_sync') and (step + 1) % accumulation_steps != 0:
+        return model.no_sync()
+    return nullcontext()
+
+
+def fused_optim_kwargs(optimizer_class, cuda=True):
+    '''
+    Input:
+        - optimizer_class: torch.optim class, e.g. torch.optim.Adam
+        - cuda: bool, whether the parameters live on a CUDA device
+    Output:
+        - {'fused': True} if the installed torch supports the fused
+        implementation of <optimizer_class>, {} otherwise
+
+    Usage:
+        torch.optim.Adam(model.parameters(), lr=lr,
+                         **fused_optim_kwargs(torch.optim.Adam, cuda))
+    '''
+    if cuda and 'fused' in inspect.signature(optimizer_class).parameters:
+        return {'fused': True}
+    return {}
+
+
+def csr_to_sparse(M, layout='csr'):
     '''    
     Input: 
         M: csr_matrix
+        layout: 'csr' for a torch.sparse_csr tensor built directly from
+                M.indptr/M.indices/M.data, 'coo' for a coalesced sparse_coo
     Output:
         torch sparse tensor
 
@@ -76,26 +127,71 @@ def csr_to_sparse(M):
         shape = torch.Size(sparse_mx.shape)
         return torch.sparse.FloatTensor(indices, values, shape)
     '''
-    n, m = M.shape
+    if layout == 'csr':
+        if not M.has_canonical_format:
+            M = M.copy()
+            M.sum_duplicates()
+        return torch.sparse_csr_tensor(
+            torch.from_numpy(M.indptr.astype(np.int64, copy=False)),
+            torch.from_numpy(M.indices.astype(np.int64, copy=False)),
+            torch.from_numpy(M.data.astype(np.float32, copy=False)),
+            size=M.shape)
+    elif layout != 'coo':
+        raise NotImplementedError("sparse layout not implemented.")
+
     coo_ = M.tocoo()
-    ix = torch.LongTensor([coo_.row, coo_.col])
-    M_t = torch.sparse.FloatTensor(ix,
-                                   torch.from_numpy(M.data).float(),
-                                   [n, m])
-    return M_t
+    # int64 indices filled in place, no stacked int32 intermediate
+    ix = np.empty((2, coo_.nnz), dtype=np.int64)
+    np.copyto(ix[0], coo_.row, casting='unsafe')
+    np.copyto(ix[1], coo_.col, casting='unsafe')
+    ix = torch.from_numpy(ix)
+    vals = torch.from_numpy(coo_.data.astype(np.float32, copy=False))
+    M_t = torch.sparse_coo_tensor(ix, vals, M.shape)
+    return M_t.coalesce()
+
+
+def _pooling_kernel(mat, ky, kx, is_max):
+    '''
+    non-padded mean/max pooling of a (bsz, m, n) array,
+    jit-compiled and parallel over the pooled rows if numba is installed
+    '''
+    bsz, m, n = mat.shape
+    ny, nx = m//ky, n//kx
+    result = np.empty((bsz, ny, nx), dtype=mat.dtype)
+    for i in prange(ny):
+        for b in range(bsz):
+            for j in range(nx):
+                if is_max:
+                    acc = mat[b, i*ky, j*kx]
+                    for p in range(ky):
+                        for q in range(kx):
+                            acc = max(acc, mat[b, i*ky+p, j*kx+q])
+                    result[b, i, j] = acc
+                else:
+                    acc = 0.
+                    for p in range(ky):
+                        for q in range(kx):
+                            acc += mat[b, i*ky+p, j*kx+q]
+                    result[b, i, j] = acc/(ky*kx)
+    return result
+
+
+if njit is not None:
+    _pooling_kernel = njit(parallel=True, cache=True)(_pooling_kernel)
 
 
 def pooling_2d(mat, kernel_size: tuple = (2, 2), method='mean', padding=False):
     '''Non-overlapping pooling on 2D data (or 2D data stacked as 3D array).
 
     mat: ndarray, input array to pool. (m, n) or (bsz, m, n)
+         a torch tensor is pooled on its own device if no padding
     kernel_size: tuple of 2, kernel size in (ky, kx).
     method: str, 'max for max-pooling, 
                    'mean' for mean-pooling.
     pad: bool, pad <mat> or not. If no pad, output has size
            n//f, n being <mat> size, f being kernel size.
-           if pad, output has size ceil(n/f), padding is nan
-           so when computing mean the 0 is counted
+           if pad, output has size ceil(n/f), padded entries
+           are not counted when computing the mean
 
     Return <result>: pooled matrix.
 
@@ -109,17 +205,32 @@ def pooling_2d(mat, kernel_size: tuple = (2, 2), method='mean', padding=False):
 
     def _ceil(x, y): return int(np.ceil(x/float(y)))
 
+    if method not in ('max', 'mean'):
+        raise NotImplementedError("pooling method not implemented.")
+
+    if torch.is_tensor(mat) and not padding:
+        pool = nn.functional.max_pool2d if method == 'max' \
+            else nn.functional.avg_pool2d
+        result = pool(mat.reshape(-1, m, n), kernel_size=kernel_size)
+        return result.reshape(mat.shape[:-2] + result.shape[-2:])
+
+    if njit is not None and not padding and mat.ndim in (2, 3) \
+            and mat.dtype in (np.float32, np.float64):
+        result = _pooling_kernel(mat.reshape(-1, m, n), ky, kx, method == 'max')
+        return result.reshape(mat.shape[:-2] + result.shape[-2:])
+
     if padding:
         ny = _ceil(m, ky)
         nx = _ceil(n, kx)
         size = mat.shape[:-2] + (ny*ky, nx*kx)
         sy = (ny*ky - m)//2
         sx = (nx*kx - n)//2
-        _sy = ny*ky - m - sy
-        _sx = nx*kx - n - sx
 
-        mat_pad = np.full(size, np.nan)
-        mat_pad[..., sy:-_sy, sx:-_sx] = mat
+        # pad with a value neutral to the reduction instead of nan
+        # so that the plain (non-nan) reductions can be used
+        fill = -np.inf if method == 'max' else 0.
+        mat_pad = np.full(size, fill)
+        mat_pad[..., sy:sy+m, sx:sx+n] = mat
     else:
         ny = m//ky
         nx = n//kx
@@ -128,11 +239,14 @@ def pooling_2d(mat, kernel_size: tuple = (2, 2), method='mean', padding=False):
     new_shape = mat.shape[:-2] + (ny, ky, nx, kx)
 
     if method == 'max':
-        result = np.nanmax(mat_pad.reshape(new_shape), axis=(-3, -1))
-    elif method == 'mean':
-        result = np.nanmean(mat_pad.reshape(new_shape), axis=(-3, -1))
+        result = mat_pad.reshape(new_shape).max(axis=(-3, -1))
+    elif padding:
+        mask = np.zeros((ny*ky, nx*kx))
+        mask[sy:sy+m, sx:sx+n] = 1
+        count = mask.reshape(ny, ky, nx, kx).sum(axis=(-3, -1))
+        result = mat_pad.reshape(new_shape).sum(axis=(-3, -1))/count
     else:
-        raise NotImplementedError("pooling method not implemented.")
+        result = mat_pad.reshape(new_shape).mean(axis=(-3, -1))
 
     return result
 
@@ -168,39 +282,62 @@ def quadpts(order=2):
     return np.array(baryCoords), np.array(weight)
 
 
-def get_distance_matrix(node, graph=False):
+def _distance_kernel(node, scale):
+    '''
+    single pass version of the non-graph branch of get_distance_matrix,
+    jit-compiled if numba is installed
+    '''
+    N = node.shape[0]
+    Ds = np.empty((N, N, 2))
+    for i in prange(N):
+        for j in range(N):
+            d = abs(node[i] - node[j]) / scale
+            Ds[i, j, 0] = np.exp(-d)
+            Ds[i, j, 1] = 1 / (1+d)
+    return Ds
+
+
+if njit is not None:
+    _distance_kernel = njit(parallel=True, cache=True)(_distance_kernel)
+
+
+def get_distance_matrix(node, graph=False, backend='numpy'):
     '''
     Input:
         - Node: nodal coords
         - graph: bool, whether to return graph distance
+        - backend: 'numpy' for an ndarray, 'torch' for a tensor computed
+          on the device of <node> (no host round trip if it is on GPU)
     Output:
         - inverse distance matrices (linear and square)
           (batch_size, N, N, 2)
     '''
-    N = len(node)
-    idx = np.arange(N)
-    Ds = []
-    for i in range(len(idx)):
+    if backend == 'torch':
+        node = torch.as_tensor(node)
         if graph:
-            d = np.abs(idx[i] - idx)
+            idx = torch.arange(len(node), device=node.device)
+            Ds = 1 / ((idx[:, None] - idx[None, :]).abs() + 1)
+            Dss = [Ds, Ds ** 2]
         else:
-            d = np.abs(node[i] - node)
-        Ds.append(d)
+            Ds = (node[:, None] - node[None, :]).abs()
+            Ds /= (Ds.max() + 1e-8)
+            Dss = [torch.exp(-Ds), 1 / (1+Ds)]
+        return torch.stack(Dss, dim=2)
+    elif backend != 'numpy':
+        raise NotImplementedError("distance backend not implemented.")
 
-    Dss = []
     if graph:
-        Ds = np.array(Ds) + 1
+        idx = np.arange(len(node))
+        Ds = np.abs(idx[:, None] - idx[None, :]) + 1
         Ds = 1 / Ds
-        Ds = np.repeat(Ds, 1, axis=0)
-        for i in [1, 2]:
-            Dss.append(Ds ** i)
+        Dss = [Ds, Ds ** 2]
+    elif njit is not None and node.ndim == 1 and node.dtype == np.float64:
+        # the largest pairwise distance in 1D is max - min
+        return _distance_kernel(node, node.max() - node.min() + 1e-8)
     else:
-        Ds = np.array(Ds)
-        max_distance = Ds.max()
-        Ds /= (max_distance + 1e-8)
-        Dss.append(np.exp(-Ds))
-        Ds = 1 / (1+Ds)
-        Dss.append(Ds)
+        Ds = np.abs(node[:, None] - node[None, :])
+        Ds /= (Ds.max() + 1e-8)
+        Dss = [np.exp(-Ds), 1 / (1+Ds)]
 
     Ds = np.stack(Dss, axis=2)
 
@@ -240,12 +377,13 @@ def get_laplacian_1d(node,
         K = 1
 
    # stiffness matrix
-    A = csr_matrix((N, N))
-    for i in range(2):
-        for j in range(2):
-            # $A_{ij}|_{\tau} = \int_{\tau}K\nabla \phi_i\cdot \nabla \phi_j dxdy$
-            Aij = h*K*Dphi[:, i]*Dphi[:, j]
-            A += csr_matrix((Aij, (elem[:, i], elem[:, j])), shape=(N, N))
+    # $A_{ij}|_{\tau} = \int_{\tau}K\nabla \phi_i\cdot \nabla \phi_j dxdy$
+    # all four local pairs are assembled at once, duplicates summed by scipy
+    ij = [(i, j) for i in range(2) for j in range(2)]
+    rows = np.concatenate([elem[:, i] for i, _ in ij])
+    cols = np.concatenate([elem[:, j] for _, j in ij])
+    Aij = np.concatenate([h*K*Dphi[:, i]*Dphi[:, j] for i, j in ij])
+    A = csr_matrix((Aij, (rows, cols)), shape=(N, N))
 
     if weight is not None:
         A += diags(weight)
@@ -291,12 +429,12 @@ def get_mass_1d(node, K=None, normalize=False):
         K = 1
 
    # mass matrix
-    M = csr_matrix((N, N))
-    for i in range(2):
-        for j in range(2):
-            # $M_{ij}|_{\tau} = \int_{\tau}K \phi_i \cdot \phi_j dx$ \
-            Mij = h*K*((i == j)+1)/6
-            M += csr_matrix((Mij, (elem[:, i], elem[:, j])), shape=(N, N))
+    # $M_{ij}|_{\tau} = \int_{\tau}K \phi_i \cdot \phi_j dx$ \
+    ij = [(i, j) for i in range(2) for j in range(2)]
+    rows = np.concatenate([elem[:, i] for i, _ in ij])
+    cols = np.concatenate([elem[:, j] for _, j in ij])
+    Mij = np.concatenate([h*K*((i == j)+1)/6 for i, j in ij])
+    M = csr_matrix((Mij, (rows, cols)), shape=(N, N))
 
     if normalize:
         D = diags(M.diagonal()**(-0.5))
@@ -591,8 +729,12 @@ def get_args_2d(subsample_nodes=3,
 
 def train_batch_burgers(model, loss_func, data, optimizer, lr_scheduler, device, grad_clip=0.999):
     optimizer.zero_grad()
-    x, edge = data["node"].to(device), data["edge"].to(device)
-    pos, grid = data['pos'].to(device), data['grid'].to(device)
+    x = data["node"].to(device, non_blocking=True)
+    edge = data["edge"].to(device, non_blocking=True)
+    pos = data['pos'].to(device, non_blocking=True)
+    grid = data['grid'].to(device, non_blocking=True)
+    # all copies are queued before the forward
+    target = data["target"].to(device, non_blocking=True)
     out_ = model(x, edge, pos, grid)
 
     if isinstance(out_, dict):
@@ -602,11 +744,10 @@ def train_batch_burgers(model, loss_func, data, optimizer, lr_scheduler, device,
         out = out_[0]
         y_latent = None
 
-    target = data["target"].to(device)
     u, up = target[..., 0], target[..., 1]
 
     if out.size(2) == 2:
-        u_pred, up_pred = out[..., 0], out[..., 1]
+        u_pred, up_pred = out.unbind(-1)
         loss, reg, ortho, _ = loss_func(
             u_pred, u, up_pred, up, preds_latent=y_latent)
     elif out.size(2) == 1:
@@ -615,7 +756,7 @@ def train_batch_burgers(model, loss_func, data, optimizer, lr_scheduler, device,
             u_pred, u, targets_prime=up, preds_latent=y_latent)
     loss = loss + reg + ortho
     loss.backward()
-    nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
+    nn.utils.clip_grad_norm_(model.parameters(), grad_clip, **CLIP_GRAD_KWARGS)
     optimizer.step()
     if lr_scheduler:
         lr_scheduler.step()
@@ -624,16 +765,22 @@ def train_batch_burgers(model, loss_func, data, optimizer, lr_scheduler, device,
     except:
         up_pred = u_pred
 
-    return (loss.item(), reg.item(), ortho.item()), u_pred, up_pred
+    # detached tensors, run_train syncs with the host only when logging
+    return (loss.detach(), reg.detach(), ortho.detach()), u_pred, up_pred
 
 
 def validate_epoch_burgers(model, metric_func, valid_loader, device):
     model.eval()
-    metric_val = []
-    for _, data in enumerate(valid_loader):
-        with torch.no_grad():
-            x, edge = data["node"].to(device), data["edge"].to(device)
-            pos, grid = data['pos'].to(device), data['grid'].to(device)
+    # running sum, np.float64 so that the mean keeps .ndim/.sum()
+    metric_sum, n_batch = np.float64(0), 0
+    # one inference_mode context for the whole epoch
+    with torch.inference_mode():
+        for _, data in enumerate(valid_loader):
+            x = data["node"].to(device, non_blocking=True)
+            edge = data["edge"].to(device, non_blocking=True)
+            pos = data['pos'].to(device, non_blocking=True)
+            grid = data['grid'].to(device, non_blocking=True)
+            target = data["target"].to(device, non_blocking=True)
             out_ = model(x, edge, pos, grid)
 
             if isinstance(out_, dict):
@@ -641,23 +788,26 @@ def validate_epoch_burgers(model, metric_func, valid_loader, device):
             elif isinstance(out_, tuple):
                 u_pred = out_[0][..., 0]
 
-            target = data["target"].to(device)
             u = target[..., 0]
             _, _, _, metric = metric_func(u_pred, u)
             try:
-                metric_val.append(metric.item())
+                metric_sum = metric_sum + metric.item()
             except:
-                metric_val.append(metric)
+                metric_sum = metric_sum + metric
+            n_batch += 1
 
-    return dict(metric=np.mean(metric_val, axis=0))
+    return dict(metric=metric_sum / n_batch)
 
 
 def train_batch_darcy(model, loss_func, data, optimizer, lr_scheduler, device, grad_clip=0.99):
     optimizer.zero_grad()
-    a, x, edge = data["coeff"].to(device), data["node"].to(
-        device), data["edge"].to(device)
-    pos, grid = data['pos'].to(device), data['grid'].to(device)
-    u, gradu = data["target"].to(device), data["target_grad"].to(device)
+    a = data["coeff"].to(device, non_blocking=True)
+    x = data["node"].to(device, non_blocking=True)
+    edge = data["edge"].to(device, non_blocking=True)
+    pos = data['pos'].to(device, non_blocking=True)
+    grid = data['grid'].to(device, non_blocking=True)
+    u = data["target"].to(device, non_blocking=True)
+    gradu = data["target_grad"].to(device, non_blocking=True)
 
     # pos is for attention, grid is the finest grid
     out_ = model(x, edge, pos=pos, grid=grid)
@@ -674,7 +824,7 @@ def train_batch_darcy(model, loss_func, data, optimizer, lr_scheduler, device, g
         loss, reg, _, _ = loss_func(u_pred, u, targets_prime=gradu, K=a)
     loss = loss + reg
     loss.backward()
-    nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
+    nn.utils.clip_grad_norm_(model.parameters(), grad_clip, **CLIP_GRAD_KWARGS)
     optimizer.step()
     if lr_scheduler:
         lr_scheduler.step()
@@ -683,31 +833,36 @@ def train_batch_darcy(model, loss_func, data, optimizer, lr_scheduler, device, g
     except:
         up_pred = u_pred
 
-    return (loss.item(), reg.item()), u_pred, up_pred
+    return (loss.detach(), reg.detach()), u_pred, up_pred
 
 
 def validate_epoch_darcy(model, metric_func, valid_loader, device):
     model.eval()
-    metric_val = []
-    for _, data in enumerate(valid_loader):
-        with torch.no_grad():
-            x, edge = data["node"].to(device), data["edge"].to(device)
-            pos, grid = data['pos'].to(device), data['grid'].to(device)
+    # running sum, np.float64 so that the mean keeps .ndim/.sum()
+    metric_sum, n_batch = np.float64(0), 0
+    # one inference_mode context for the whole epoch
+    with torch.inference_mode():
+        for _, data in enumerate(valid_loader):
+            x = data["node"].to(device, non_blocking=True)
+            edge = data["edge"].to(device, non_blocking=True)
+            pos = data['pos'].to(device, non_blocking=True)
+            grid = data['grid'].to(device, non_blocking=True)
+            target = data["target"].to(device, non_blocking=True)
             out_ = model(x, edge, pos=pos, grid=grid)
             if isinstance(out_, dict):
                 out = out_['preds']
             elif isinstance(out_, tuple):
                 out = out_[0]
             u_pred = out[..., 0]
-            target = data["target"].to(device)
             u = target[..., 0]
             _, _, metric, _ = metric_func(u_pred, u)
             try:
-                metric_val.append(metric.item())
+                metric_sum = metric_sum + metric.item()
             except:
-                metric_val.append(metric)
+                metric_sum = metric_sum + metric
+            n_batch += 1
 
-    return dict(metric=np.mean(metric_val, axis=0))
+    return dict(metric=metric_sum / n_batch)
 
 
 def run_train(model, loss_func, metric_func,
@@ -726,10 +881,10 @@ def run_train(model, loss_func, metric_func,
               save_mode='state_dict',  # 'state_dict' or 'entire'
               model_name='model.pt',
               result_name='result.pt'):
-    loss_train = []
-    loss_val = []
-    loss_epoch = []
-    lr_history = []
+    # preallocated histories, loss_train/loss_val once their shapes are known
+    loss_train, loss_val = None, None
+    loss_sum, n_batch = 0, 0
+    lr_history = np.empty(epochs*len(train_loader))
     it = 0
 
     if patience is None or patience == 0:
@@ -742,32 +897,47 @@ def run_train(model, loss_func, metric_func,
     stop_counter = 0
     is_epoch_scheduler = any(s in str(lr_scheduler.__class__)
                              for s in EPOCH_SCHEDULERS)
+    # resolved once: 'plateau' and 'epoch' step after validation
+    if isinstance(lr_scheduler, ReduceLROnPlateau):
+        sched_kind = 'plateau'
+    elif is_epoch_scheduler:
+        sched_kind = 'epoch'
+    else:
+        sched_kind = 'batch'
+    batch_scheduler = lr_scheduler if sched_kind == 'batch' else None
     tqdm_epoch = False if tqdm_mode == 'batch' else True
+    # USE_COMPILE=1: train/validate through torch.compile (torch>=2.0),
+    # <model> itself is what gets saved, so the state dict keys are unchanged
+    if USE_COMPILE and hasattr(torch, 'compile'):
+        model_ = torch.compile(model, mode='reduce-overhead', dynamic=False)
+    else:
+        model_ = model
 
     with tqdm(total=end_epoch-start_epoch, disable=not tqdm_epoch) as pbar_ep:
         for epoch in range(start_epoch, end_epoch):
             model.train()
             with tqdm(total=len(train_loader), disable=tqdm_epoch) as pbar_batch:
                 for batch in train_loader:
-                    if is_epoch_scheduler:
-                        loss, _, _ = train_batch(model, loss_func,
-                                                 batch, optimizer,
-                                                 None, device, grad_clip=grad_clip)
-                    else:
-                        loss, _, _ = train_batch(model, loss_func,
-                                                 batch, optimizer,
-                                                 lr_scheduler, device, grad_clip=grad_clip)
-                    loss = np.array(loss)
-                    loss_epoch.append(loss)
-                    it += 1
+                    loss, _, _ = train_batch(model_, loss_func,
+                                             batch, optimizer,
+                                             batch_scheduler, device, grad_clip=grad_clip)
+                    # losses stay on device, summed without a host sync
+                    if isinstance(loss, (tuple, list)):
+                        loss = torch.stack([torch.as_tensor(l).reshape(())
+                                            for l in loss])
+                    loss_sum = loss_sum + torch.as_tensor(loss).double()
+                    n_batch += 1
                     lr = optimizer.param_groups[0]['lr']
-                    lr_history.append(lr)
+                    lr_history[it] = lr
+                    it += 1
+                    if tqdm_epoch:
+                        continue
                     desc = f"epoch: [{epoch+1}/{end_epoch}]"
-                    if loss.ndim == 0:  # 1 target loss
-                        _loss_mean = np.mean(loss_epoch)
+                    # running mean, no reduction over the whole epoch per batch
+                    _loss_mean = (loss_sum / n_batch).cpu().numpy()[()]
+                    if _loss_mean.ndim == 0:  # 1 target loss
                         desc += f" loss: {_loss_mean:.3e}"
                     else:
-                        _loss_mean = np.mean(loss_epoch, axis=0)
                         for j in range(len(_loss_mean)):
                             if _loss_mean[j] > 0:
                                 desc += f" | loss {j}: {_loss_mean[j]:.3e}"
@@ -775,14 +945,19 @@ def run_train(model, loss_func, metric_func,
                     pbar_batch.set_description(desc)
                     pbar_batch.update()
 
-            loss_train.append(_loss_mean)
-            # loss_train.append(loss_epoch)
-            loss_epoch = []
+            _loss_mean = (loss_sum / n_batch).cpu().numpy()[()]
+            if loss_train is None:
+                loss_train = np.empty((epochs,) + np.shape(_loss_mean))
+            loss_train[epoch-start_epoch] = _loss_mean
+            loss_sum, n_batch = 0, 0
 
             val_result = validate_epoch(
-                model, metric_func, valid_loader, device)
+                model_, metric_func, valid_loader, device)
 
-            loss_val.append(val_result["metric"])
+            if loss_val is None:
+                loss_val = np.empty(
+                    (epochs,) + np.shape(val_result["metric"]))
+            loss_val[epoch-start_epoch] = val_result["metric"]
             val_metric = val_result["metric"].sum()
             if mode == 'max':
                 if val_metric > best_val_metric:
@@ -796,27 +971,29 @@ def run_train(model, loss_func, metric_func,
                     best_val_epoch = epoch
                     best_val_metric = val_metric
                     stop_counter = 0
+                    # a single pass over the state dict, copied to the host
+                    best_model_state_dict = OrderedDict(
+                        (k, v.detach().to('cpu', non_blocking=True))
+                        for k, v in model.state_dict().items())
+                    if torch.cuda.is_available():
+                        torch.cuda.synchronize()
+                    save_path = os.path.join(model_save_path, model_name)
                     if save_mode == 'state_dict':
-                        torch.save(model.state_dict(), os.path.join(
-                            model_save_path, model_name))
+                        atomic_torch_save(best_model_state_dict, save_path)
                     else:
-                        torch.save(model, os.path.join(
-                            model_save_path, model_name))
-                    best_model_state_dict = {
-                        k: v.to('cpu') for k, v in model.state_dict().items()}
-                    best_model_state_dict = OrderedDict(best_model_state_dict)
+                        atomic_torch_save(model, save_path)
 
                 else:
                     stop_counter += 1
 
-            if lr_scheduler and is_epoch_scheduler:
-                if 'ReduceLROnPlateau' in str(lr_scheduler.__class__):
-                    lr_scheduler.step(val_metric)
-                else:
-                    lr_scheduler.step()
+            if lr_scheduler and sched_kind == 'plateau':
+                lr_scheduler.step(val_metric)
+            elif lr_scheduler and sched_kind == 'epoch':
+                lr_scheduler.step()
 
             if stop_counter > patience:
                 print(f"Early stop at epoch {epoch}")
+                save_pickle(result, os.path.join(model_save_path, result_name))
                 break
             if val_result["metric"].ndim == 0:
                 desc = color(
@@ -850,13 +1027,15 @@ def run_train(model, loss_func, metric_func,
             result = dict(
                 best_val_epoch=best_val_epoch,
                 best_val_metric=best_val_metric,
-                loss_train=np.asarray(loss_train),
-                loss_val=np.asarray(loss_val),
-                lr_history=np.asarray(lr_history),
+                loss_train=loss_train[:epoch-start_epoch+1],
+                loss_val=loss_val[:epoch-start_epoch+1],
+                lr_history=lr_history[:it],
                 # best_model=best_model_state_dict,
                 optimizer_state=optimizer.state_dict()
             )
-            save_pickle(result, os.path.join(model_save_path, result_name))
+            # written only on improvement, early stop or the last epoch
+            if stop_counter == 0 or epoch == end_epoch - 1:
+                save_pickle(result, os.path.join(model_save_path, result_name))
     return result
 
 